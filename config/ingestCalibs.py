@@ -14,5 +14,5 @@ config.parse.translators = {'ccd': 'translate_ccd',
                             }
 
 config.register.unique = ['filter', 'ccd', 'calibDate']
-config.register.tables = ['bias', 'dark', 'flat', 'fringe']
+config.register.tables = ['bias', 'dark', 'flat', 'fringe', 'crosstalk']
 config.register.visit = ['calibDate', 'filter']
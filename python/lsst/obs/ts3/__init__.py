@@ -19,6 +19,35 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import importlib
+import sys
+
 from .version import *
-from .ts3Mapper import *
-from .ts3IsrTask import *
+from . import version as _version
+
+# The mapper and ISR task pull in afw.cameraGeom, ip_isr and pipe_base; import them on first
+# use so that processes which only need e.g. the ingest parser start quickly.  Module-level
+# __getattr__ needs python 3.7, so older interpreters import them eagerly.
+_lazyAttributes = {
+    "Ts3Mapper": "ts3Mapper",
+    "Ts3IsrConfig": "ts3IsrTask",
+    "Ts3IsrTask": "ts3IsrTask",
+}
+
+__all__ = list(_version.__all__) + list(_lazyAttributes)
+
+if sys.version_info < (3, 7):
+    from .ts3Mapper import *
+    from .ts3IsrTask import *
+else:
+    def __getattr__(name):
+        try:
+            moduleName = _lazyAttributes[name]
+        except KeyError:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+        value = getattr(importlib.import_module("." + moduleName, __name__), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_lazyAttributes))
@@ -0,0 +1,81 @@
+#
+# LSST Data Management System
+# Copyright 2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Reading and writing the Ts3 crosstalk calibration
+
+The crosstalk calibration is a 16x16 floating-point FITS image whose pixel (x=j, y=i) is the
+fraction of the signal in channel j+1 that appears in channel i+1.  So that ingestCalibs.py
+can register it, the primary header must have:
+
+    OBSTYPE  = 'crosstalk'
+    CALIB_ID = 'ccd=0 filter=NONE calibDate=YYYY-MM-DD'
+
+writeCrosstalk writes such a file.
+"""
+import numpy
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+
+__all__ = ["writeCrosstalk", "crosstalkFromImage"]
+
+NUM_AMPS = 16
+
+
+def writeCrosstalk(coeffs, filename, calibDate, filterName="NONE", ccd=0):
+    """!Write a crosstalk matrix as a calibration that ingestCalibs.py can register
+
+    \param[in] coeffs -- 16x16 array; element [i, j] is the fraction of the signal in
+                         channel j+1 that appears in channel i+1
+    \param[in] filename -- name of FITS file to write
+    \param[in] calibDate -- calibration date, as YYYY-MM-DD
+    \param[in] filterName -- filter name for the calib registry
+    \param[in] ccd -- ccd number for the calib registry
+    """
+    coeffs = numpy.array(coeffs, dtype=numpy.float32)
+    if coeffs.shape != (NUM_AMPS, NUM_AMPS):
+        raise RuntimeError("Crosstalk matrix has shape %s; expected (%d, %d)" %
+                           (coeffs.shape, NUM_AMPS, NUM_AMPS))
+    image = afwImage.DecoratedImageF(afwGeom.Extent2I(NUM_AMPS, NUM_AMPS))
+    image.getImage().getArray()[:] = coeffs
+    metadata = dafBase.PropertyList()
+    metadata.set("OBSTYPE", "crosstalk")
+    metadata.set("CALIB_ID", "ccd=%d filter=%s calibDate=%s" % (ccd, filterName, calibDate))
+    image.setMetadata(metadata)
+    image.writeFits(filename)
+
+
+def crosstalkFromImage(item, dataId=None):
+    """!Convert a crosstalk calibration image to a numpy array
+
+    \param[in] item -- crosstalk calibration, as a DecoratedImageF or ImageF
+    \param[in] dataId -- data identifier, for error messages
+    \return 16x16 numpy array; element [i, j] is the fraction of the signal in channel
+            j+1 that appears in channel i+1
+    """
+    if hasattr(item, "getImage"):  # For DecoratedImageX
+        item = item.getImage()
+    coeffs = item.getArray().astype(numpy.float64)
+    if coeffs.shape != (NUM_AMPS, NUM_AMPS):
+        raise RuntimeError("Crosstalk matrix for %s has shape %s; expected (%d, %d)" %
+                           (dataId, coeffs.shape, NUM_AMPS, NUM_AMPS))
+    return coeffs
@@ -21,12 +21,95 @@ from builtins import range
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
+import hashlib
+import importlib
+import re
 import numpy
+import lsst.afw.detection as afwDetection
+import lsst.afw.geom as afwGeom
 import lsst.ip.isr as ip_isr
+import lsst.meas.algorithms as measAlg
+from lsst.ip.isr import isrFunctions
+import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipe_base
+from . import version as obsTs3Version
+
+try:
+    from StringIO import StringIO  # python 2: pex_config writes str
+except ImportError:
+    from io import StringIO
+
+__all__ = ["Ts3IsrConfig", "Ts3IsrTask"]
+
+
+def _getPackageVersion(moduleName):
+    """!Return the version of an LSST python package
+
+    Uses the sconsUtils-generated version module if there is one, and otherwise eups.
+
+    \param[in] moduleName -- python module name of the package, e.g. "lsst.ip.isr"
+    \return the version string, or None if it cannot be determined
+    """
+    try:
+        version = importlib.import_module(moduleName + ".version")
+        return getattr(version, "__fingerprint__", None) or getattr(version, "__version__", None)
+    except ImportError:
+        pass
+    try:
+        import eups
+        productName = moduleName.replace("lsst.", "", 1).replace(".", "_")
+        return eups.getSetupVersion(productName)
+    except Exception:
+        return None
+
+
+def _updateHashFromFile(hasher, filename, chunkSize=1 << 20):
+    """!Feed the contents of a file to a hashlib object
+
+    \param[in,out] hasher -- hashlib object to update
+    \param[in] filename -- name of file to read
+    \param[in] chunkSize -- number of bytes to read at a time
+    """
+    with open(filename, "rb") as fd:
+        for chunk in iter(lambda: fd.read(chunkSize), b""):
+            hasher.update(chunk)
+
+
+class Ts3IsrConfig(ip_isr.IsrConfig):
+    doCombinedInterp = pexConfig.Field(
+        dtype=bool,
+        doc="Interpolate over defects, saturated pixels and NaNs in a single sweep (maskAndInterpCombined) "
+            "instead of calling maskAndInterpDefect, saturationInterpolation and maskAndInterpNan in turn?  "
+            "The masks and NUMNANS are the same; the image differs only next to places where defects, "
+            "saturated regions and NaNs touch.",
+        default=False,
+    )
+    doCrosstalk = pexConfig.Field(
+        dtype=bool,
+        doc="Correct for inter-amplifier crosstalk using the \"crosstalk\" calibration matrix?",
+        default=False,
+    )
+    doSkipUnchanged = pexConfig.Field(
+        dtype=bool,
+        doc="Skip ISR in runDataRef if postISRCCD already exists and was made from the same raw file, "
+            "calibs, defects, config and versions of obs_ts3 and the packages it uses to make the pixels "
+            "(as recorded in its ISR_PROVENANCE header)?  Requires doWrite, since the provenance is only "
+            "recorded when postISRCCD is written.  This field and doWrite are not part of the provenance.",
+        default=False,
+    )
+
+    def validate(self):
+        ip_isr.IsrConfig.validate(self)
+        if self.doSkipUnchanged and not self.doWrite:
+            raise ValueError("doSkipUnchanged requires doWrite, as the provenance is recorded in postISRCCD")
 
 
 class Ts3IsrTask(ip_isr.IsrTask):
+    ConfigClass = Ts3IsrConfig
+    # Config fields that don't change the pixels, and are left out of the provenance digest
+    PROVENANCE_IGNORED_FIELDS = ("doSkipUnchanged", "doWrite")
+    # Packages whose versions can change the pixels of postISRCCD
+    PROVENANCE_PACKAGES = ("lsst.afw", "lsst.ip.isr", "lsst.meas.algorithms")
 
     @pipe_base.timeMethod
     def run(self, ccdExposure, bias=None, dark=None, flat=None, defects=None, fringes=None, bfKernel=None,
@@ -102,11 +185,14 @@ class Ts3IsrTask(ip_isr.IsrTask):
         if self.config.doFlat:
             self.flatCorrection(ccdExposure, flat)
 
-        self.maskAndInterpDefect(ccdExposure, defects)
+        if self.config.doCombinedInterp:
+            self.maskAndInterpCombined(ccdExposure, defects)
+        else:
+            self.maskAndInterpDefect(ccdExposure, defects)
 
-        self.saturationInterpolation(ccdExposure)
+            self.saturationInterpolation(ccdExposure)
 
-        self.maskAndInterpNan(ccdExposure)
+            self.maskAndInterpNan(ccdExposure)
 
         if self.config.doFringe and self.config.fringeAfterFlat:
             self.fringe.run(ccdExposure, **fringes.getDict())
@@ -117,22 +203,226 @@ class Ts3IsrTask(ip_isr.IsrTask):
             exposure=ccdExposure,
         )
 
+    def maskAndInterpCombined(self, ccdExposure, defectBaseList):
+        """!Mask defects, saturated pixels and NaNs, and interpolate over all of them in one sweep
+
+        The masks are set as by maskAndInterpDefect, saturationInterpolation and maskAndInterpNan
+        (including the grown SAT footprints), and NUMNANS only counts the NaNs outside the defects
+        and saturated regions, which the sequential path would already have interpolated away.
+        The defects are passed to the interpolation as given.
+
+        Unlike the sequential path, all the bad regions are interpolated in a single call, so
+        pixels next to a region that touches another kind of bad region are interpolated from
+        the far side of the combined region rather than from already-interpolated values.  Away
+        from such contacts the image is the same.
+
+        \param[in,out] ccdExposure -- exposure to process
+        \param[in] defectBaseList -- a list of defects to mask and interpolate
+        """
+        maskedImage = ccdExposure.getMaskedImage()
+        mask = maskedImage.getMask()
+        maskArray = mask.getArray()
+        imageBBox = ccdExposure.getBBox()
+        x0, y0 = imageBBox.getMinX(), imageBBox.getMinY()
+
+        defectList = measAlg.DefectListT()
+        isCovered = numpy.zeros(maskArray.shape, dtype=bool)
+        for defectBase in defectBaseList:
+            defectList.append(measAlg.Defect(defectBase.getBBox()))
+            bbox = afwGeom.Box2I(defectBase.getBBox())
+            bbox.clip(imageBBox)
+            if not bbox.isEmpty():
+                isCovered[bbox.getMinY() - y0:bbox.getMaxY() - y0 + 1,
+                          bbox.getMinX() - x0:bbox.getMaxX() - x0 + 1] = True
+        isrFunctions.maskPixelsFromDefectList(maskedImage, defectList, maskName='BAD')
+
+        # As isrFunctions.interpolateFromMask: grow the saturated footprints and mark them SAT
+        satBit = mask.getPlaneBitMask(self.config.saturatedMaskName)
+        fpSet = afwDetection.FootprintSet(mask, afwDetection.Threshold(satBit,
+                                                                      afwDetection.Threshold.BITMASK))
+        if self.config.growSaturationFootprintSize > 0:
+            fpSet = afwDetection.FootprintSet(fpSet, self.config.growSaturationFootprintSize)
+        fpSet.setMask(mask, self.config.saturatedMaskName)
+        for defect in isrFunctions.defectListFromFootprintList(fpSet.getFootprints()):
+            defectList.append(defect)
+        isCovered |= (maskArray & satBit) != 0
+
+        # As ip_isr's maskNans, but only for pixels that the sequential path would not already
+        # have interpolated over
+        mask.addMaskPlane("UNMASKEDNAN")
+        isNan = ~(numpy.isfinite(maskedImage.getImage().getArray()) &
+                  numpy.isfinite(maskedImage.getVariance().getArray()))
+        isNan &= ~isCovered
+        numNans = int(isNan.sum())
+        self.metadata.set("NUMNANS", numNans)
+        if numNans > 0:
+            self.log.warn("There were %i unmasked NaNs" % (numNans,))
+            maskArray[isNan] |= mask.getPlaneBitMask("UNMASKEDNAN")
+            for defect in isrFunctions.getDefectListFromMask(maskedImage, "UNMASKEDNAN", growFootprints=0):
+                defectList.append(defect)
+
+        if len(defectList) > 0:
+            isrFunctions.interpolateDefectList(maskedImage=maskedImage, defectList=defectList,
+                                              fwhm=self.config.fwhm)
+
+    def crosstalkCorrection(self, ampList, coeffs):
+        """!Remove inter-amplifier crosstalk from overscan-corrected amp exposures
+
+        The data sections are stacked in each amp's readout orientation (the raws are in amp
+        coordinates) and corrected with a single matrix product, rather than one subtraction
+        per pair of amps.
+
+        \param[in,out] ampList -- list of (ampExposure, amp) in channel order
+        \param[in] coeffs -- crosstalk matrix; element [i, j] is the fraction of the signal
+                              in amp j that appears in amp i
+        """
+        coeffs = numpy.array(coeffs, dtype=float)
+        if coeffs.shape != (len(ampList), len(ampList)):
+            raise RuntimeError("Crosstalk matrix has shape %s; expected (%d, %d)" %
+                               ((coeffs.shape,) + (len(ampList),)*2))
+        numpy.fill_diagonal(coeffs, 0.0)
+
+        dataList = [ampExposure.getMaskedImage().getImage().Factory(
+                    ampExposure.getMaskedImage().getImage(), amp.getRawDataBBox()).getArray()
+                    for ampExposure, amp in ampList]
+        stack = numpy.array(dataList)
+        # Keep the product in the pixel type, to avoid float64 copies of the whole stack
+        correction = numpy.dot(coeffs.astype(stack.dtype),
+                               stack.reshape(len(dataList), -1)).reshape(stack.shape)
+        for data, ampCorrection in zip(dataList, correction):
+            data -= ampCorrection
+
+    def getProvenanceDatasetTypes(self):
+        """!Return the file-backed datasets that runDataRef reads for the current config
+
+        This follows readIsrData (plus the raw data and crosstalk read by runDataRef), and
+        must be kept in step with it.  Defects are returned by Ts3Mapper.bypass_defects
+        rather than read from a file, so they are hashed separately.
+
+        \return a list of dataset type names
+        """
+        return ["raw"] + [datasetType for datasetType, doRead in (
+            ("bias", self.config.doBias),
+            ("linearizer", self.config.doLinearize),
+            ("dark", self.config.doDark),
+            ("flat", self.config.doFlat),
+            ("bfKernel", self.config.doBrighterFatter),
+            ("fringe", self.config.doFringe),
+            ("crosstalk", self.config.doCrosstalk),
+        ) if doRead]
+
+    def getProvenanceVersions(self):
+        """!Return the versions of obs_ts3 and of the packages in PROVENANCE_PACKAGES
+
+        A package whose version cannot be determined is logged and recorded as "unknown".
+
+        \return a dict of version string indexed by python module name
+        """
+        versions = {"lsst.obs.ts3": obsTs3Version.__fingerprint__}
+        for moduleName in self.PROVENANCE_PACKAGES:
+            version = _getPackageVersion(moduleName)
+            if version is None:
+                self.log.warn("Unable to determine the version of %s for the ISR provenance" % (moduleName,))
+                version = "unknown"
+            versions[moduleName] = version
+        return versions
+
+    def computeProvenanceDigest(self, sensorRef):
+        """!Compute a digest of everything that determines the postISRCCD for a sensor
+
+        The digest covers the contents of the files of getProvenanceDatasetTypes(), the
+        defects, the task config (apart from fields in PROVENANCE_IGNORED_FIELDS, which do
+        not affect the pixels) and the versions from getProvenanceVersions().
+
+        \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the detector data
+        \return the digest as a hexadecimal string
+        """
+        hasher = hashlib.sha1()
+        for name, version in sorted(self.getProvenanceVersions().items()):
+            hasher.update(("%s %s" % (name, version)).encode())
+
+        for datasetType in self.getProvenanceDatasetTypes():
+            hasher.update(datasetType.encode())
+            if not sensorRef.datasetExists(datasetType):
+                # e.g. a fringe frame for a filter that isn't fringe-corrected
+                hasher.update(b"missing")
+                continue
+            for filename in sensorRef.get(datasetType + "_filename"):
+                _updateHashFromFile(hasher, filename)
+
+        for defect in sensorRef.get("defects", immediate=True):
+            bbox = defect.getBBox()
+            hasher.update(("defect %d %d %d %d" % (bbox.getMinX(), bbox.getMinY(),
+                                                   bbox.getMaxX(), bbox.getMaxY())).encode())
+
+        configStream = StringIO()
+        self.config.saveToStream(configStream, root="config")
+        ignored = re.compile(r"^config\.(%s)=" % "|".join(self.PROVENANCE_IGNORED_FIELDS))
+        for line in configStream.getvalue().splitlines():
+            if not ignored.match(line):
+                hasher.update(line.encode())
+
+        return hasher.hexdigest()
+
+    def isProvenanceCurrent(self, sensorRef, digest):
+        """!Does the existing postISRCCD for a sensor have the given provenance digest?
+
+        \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the detector data
+        \param[in] digest -- digest from computeProvenanceDigest
+        \return a pipe_base.Struct with fields:
+        - current: True if the existing postISRCCD was made from the same inputs
+        - reason: why ISR can or cannot be skipped
+        """
+        if not sensorRef.datasetExists("postISRCCD"):
+            return pipe_base.Struct(current=False, reason="there is no existing postISRCCD")
+        metadata = sensorRef.get("postISRCCD_md", immediate=True)
+        if not metadata.exists("ISR_PROVENANCE"):
+            return pipe_base.Struct(current=False, reason="the existing postISRCCD has no provenance")
+        if metadata.get("ISR_PROVENANCE") != digest:
+            return pipe_base.Struct(current=False,
+                                    reason="the raw, calibs, defects or config differ from those used "
+                                    "for the existing postISRCCD")
+        return pipe_base.Struct(current=True,
+                                reason="the existing postISRCCD was made from the same raw, calibs, "
+                                "defects and config (provenance %s)" % (digest,))
+
     @pipe_base.timeMethod
     def runDataRef(self, sensorRef):
         """!Perform instrument signature removal on a ButlerDataRef of a Sensor
 
         - Read in necessary detrending/isr/calibration data
         - Process raw exposure in run()
-        - Persist the ISR-corrected exposure as "postISRCCD" if config.doWrite is True
+        - Persist the ISR-corrected exposure as "postISRCCD" if config.doWrite is True,
+          recording the provenance digest in its ISR_PROVENANCE header
+
+        If config.doSkipUnchanged is True and the existing postISRCCD has the same provenance
+        digest, ISR is skipped and the existing postISRCCD is returned.
 
         \param[in] sensorRef -- daf.persistence.butlerSubset.ButlerDataRef of the
                                 detector data to be processed
         \return a pipe_base.Struct with fields:
         - exposure: the exposure after application of ISR
         """
+        digest = self.computeProvenanceDigest(sensorRef) if self.config.doWrite else None
+        if self.config.doSkipUnchanged and digest is not None:
+            provenance = self.isProvenanceCurrent(sensorRef, digest)
+            self.metadata.set("ISR_SKIPPED", provenance.current)
+            if provenance.current:
+                self.log.info("Skipping ISR on sensor %s: %s" % (sensorRef.dataId, provenance.reason))
+                return pipe_base.Struct(
+                    exposure=sensorRef.get("postISRCCD", immediate=True),
+                )
+            self.log.info("Redoing ISR on sensor %s: %s" % (sensorRef.dataId, provenance.reason))
+
         self.log.info("Performing ISR on sensor %s" % (sensorRef.dataId))
+        crosstalk = None
+        if self.config.doCrosstalk:
+            if not sensorRef.datasetExists("crosstalk"):
+                raise RuntimeError("Must supply a crosstalk calibration if config.doCrosstalk True")
+            crosstalk = sensorRef.get("crosstalk", immediate=True)
         # We should probably loop over this using the butler.
         ampDict = {}
+        ampList = []
         for channel in range(16):
             sensorRef.dataId['channel'] = channel+1  # to get the correct channel
             ampExposure = sensorRef.get('raw_amp', immediate=True)
@@ -143,12 +433,17 @@ class Ts3IsrTask(ip_isr.IsrTask):
             self.saturationDetection(ampExposure, amp)
             self.overscanCorrection(ampExposure, amp)
             ampDict[amp.getName()] = ampExposure
+            ampList.append((ampExposure, amp))
+
+        if self.config.doCrosstalk:
+            self.crosstalkCorrection(ampList, crosstalk)
 
         ccdExposure = self.assembleCcd.assembleCcd(ampDict)
         isrData = self.readIsrData(sensorRef, ccdExposure)
         result = self.run(ccdExposure, **isrData.getDict())
 
         if self.config.doWrite:
+            result.exposure.getMetadata().set("ISR_PROVENANCE", digest)
             sensorRef.put(result.exposure, "postISRCCD")
 
         return result
@@ -27,6 +27,7 @@ import lsst.afw.image as afwImage
 from lsst.obs.base import CameraMapper
 import lsst.pex.policy as pexPolicy
 from .ts3 import Ts3
+from .crosstalk import crosstalkFromImage
 
 __all__ = ["Ts3Mapper"]
 
@@ -174,3 +175,12 @@ class Ts3Mapper(CameraMapper):
 
     def std_fringe(self, item, dataId):
         return self.standardizeCalib("flat", item, dataId)
+
+    def std_crosstalk(self, item, dataId):
+        """Convert a crosstalk calibration to a numpy array
+
+        The calibration is a 16x16 image whose pixel (x=j, y=i) is the fraction of the
+        signal in channel j+1 that appears in channel i+1.  See lsst.obs.ts3.crosstalk for
+        the headers needed to ingest it.
+        """
+        return crosstalkFromImage(item, dataId)
@@ -0,0 +1,162 @@
+#
+# LSST Data Management System
+# Copyright 2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import print_function
+import time
+import unittest
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.utils.tests
+from lsst.obs.ts3 import Ts3IsrTask
+
+
+def makeDefects(boxes):
+    """Make a list of defects from (x0, y0, x1, y1) tuples"""
+    return [afwImage.DefectBase(afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Point2I(x1, y1)))
+            for x0, y0, x1, y1 in boxes]
+
+
+class CombinedInterpTestCase(lsst.utils.tests.TestCase):
+    """Compare Ts3IsrTask.maskAndInterpCombined with the sequential defect, saturation and NaN stages"""
+
+    def makeExposure(self, width, height, satBoxes=(), nanPixels=(), infVariancePixels=(), seed=12345):
+        """Make a flat-ish exposure with saturated boxes (x0, y0, x1, y1) and NaN pixels (x, y)"""
+        rng = numpy.random.RandomState(seed)
+        exposure = afwImage.ExposureF(afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(width, height)))
+        maskedImage = exposure.getMaskedImage()
+        image = maskedImage.getImage().getArray()
+        image[:] = 1000.0 + rng.normal(0.0, 10.0, image.shape)
+        variance = maskedImage.getVariance().getArray()
+        variance[:] = 100.0
+        mask = maskedImage.getMask()
+        for x0, y0, x1, y1 in satBoxes:
+            mask.getArray()[y0:y1 + 1, x0:x1 + 1] |= mask.getPlaneBitMask("SAT")
+            image[y0:y1 + 1, x0:x1 + 1] = 70000.0
+        for x, y in nanPixels:
+            image[y, x] = numpy.nan
+        for x, y in infVariancePixels:
+            variance[y, x] = numpy.inf
+        return exposure
+
+    def runBoth(self, exposure, defects):
+        """Run the sequential and combined paths on copies of an exposure
+
+        @return sequential exposure, sequential task, combined exposure, combined task
+        """
+        sequentialExposure = exposure.clone()
+        sequentialTask = Ts3IsrTask()
+        sequentialTask.maskAndInterpDefect(sequentialExposure, defects)
+        sequentialTask.saturationInterpolation(sequentialExposure)
+        sequentialTask.maskAndInterpNan(sequentialExposure)
+
+        combinedExposure = exposure.clone()
+        combinedTask = Ts3IsrTask()
+        combinedTask.maskAndInterpCombined(combinedExposure, defects)
+        return sequentialExposure, sequentialTask, combinedExposure, combinedTask
+
+    def testSeparatedRegions(self):
+        """Regions that don't touch give identical results"""
+        exposure = self.makeExposure(120, 90, satBoxes=[(50, 30, 59, 39)],
+                                     nanPixels=[(10, 10), (11, 10), (90, 60)],
+                                     infVariancePixels=[(20, 70)])
+        defects = makeDefects([(5, 50, 8, 60), (80, 20, 100, 22)])
+        sequential, sequentialTask, combined, combinedTask = self.runBoth(exposure, defects)
+
+        for plane in ("getImage", "getMask", "getVariance"):
+            numpy.testing.assert_array_equal(getattr(combined.getMaskedImage(), plane)().getArray(),
+                                             getattr(sequential.getMaskedImage(), plane)().getArray(),
+                                             err_msg=plane)
+        self.assertEqual(combinedTask.metadata.get("NUMNANS"), 4)
+        self.assertEqual(combinedTask.metadata.get("NUMNANS"), sequentialTask.metadata.get("NUMNANS"))
+
+    def testTouchingRegions(self):
+        """Overlapping regions give the same masks and NUMNANS, and differ only where interpolated"""
+        exposure = self.makeExposure(120, 90, satBoxes=[(50, 30, 59, 39)],
+                                     nanPixels=[(47, 36), (55, 41), (10, 10), (11, 10), (12, 11)],
+                                     infVariancePixels=[(20, 60)])
+        defects = makeDefects([(45, 35, 52, 45), (44, 40, 48, 50), (100, 70, 110, 75)])
+        sequential, sequentialTask, combined, combinedTask = self.runBoth(exposure, defects)
+
+        sequentialMask = sequential.getMaskedImage().getMask()
+        combinedMask = combined.getMaskedImage().getMask()
+        numpy.testing.assert_array_equal(combinedMask.getArray(), sequentialMask.getArray())
+        self.assertEqual(combinedTask.metadata.get("NUMNANS"), sequentialTask.metadata.get("NUMNANS"))
+
+        # Only interpolated pixels may differ
+        notInterpolated = (combinedMask.getArray() & combinedMask.getPlaneBitMask("INTRP")) == 0
+        self.assertTrue(notInterpolated.any())
+        for plane in ("getImage", "getVariance"):
+            numpy.testing.assert_array_equal(
+                getattr(combined.getMaskedImage(), plane)().getArray()[notInterpolated],
+                getattr(sequential.getMaskedImage(), plane)().getArray()[notInterpolated],
+                err_msg=plane)
+        self.assertTrue(numpy.all(numpy.isfinite(combined.getMaskedImage().getImage().getArray())))
+
+    def testNothingToDo(self):
+        exposure = self.makeExposure(20, 20)
+        task = Ts3IsrTask()
+        task.maskAndInterpCombined(exposure, [])
+        self.assertEqual(task.metadata.get("NUMNANS"), 0)
+        self.assertFalse(numpy.any(exposure.getMaskedImage().getMask().getArray()))
+
+    def testTiming(self):
+        """Report the time for both paths on a full-size bright flat with many saturated spots"""
+        rng = numpy.random.RandomState(54321)
+        satBoxes = []
+        for x, y in zip(rng.randint(0, 4060, 400), rng.randint(0, 3970, 400)):
+            satBoxes.append((x, y, x + rng.randint(5, 30), y + rng.randint(5, 30)))
+        nanPixels = list(zip(rng.randint(0, 4096, 200), rng.randint(0, 4004, 200)))
+        exposure = self.makeExposure(4096, 4004, satBoxes=satBoxes, nanPixels=nanPixels)
+        defects = makeDefects([(3801, 666, 3805, 669), (3934, 582, 3936, 589)])
+
+        sequentialExposure = exposure.clone()
+        start = time.time()
+        task = Ts3IsrTask()
+        task.maskAndInterpDefect(sequentialExposure, defects)
+        task.saturationInterpolation(sequentialExposure)
+        task.maskAndInterpNan(sequentialExposure)
+        sequentialTime = time.time() - start
+
+        combinedExposure = exposure.clone()
+        start = time.time()
+        Ts3IsrTask().maskAndInterpCombined(combinedExposure, defects)
+        combinedTime = time.time() - start
+        print("Defect/saturation/NaN interpolation: sequential %.3f sec, combined %.3f sec" %
+              (sequentialTime, combinedTime))
+
+        numpy.testing.assert_array_equal(combinedExposure.getMaskedImage().getMask().getArray(),
+                                         sequentialExposure.getMaskedImage().getMask().getArray())
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,242 @@
+#
+# LSST Data Management System
+# Copyright 2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.utils.tests
+from lsst.obs.ts3 import Ts3IsrConfig, Ts3IsrTask, Ts3Mapper
+from lsst.obs.ts3.crosstalk import writeCrosstalk, crosstalkFromImage
+from lsst.obs.ts3.ts3 import Ts3
+
+
+def naiveCrosstalkCorrection(ampList, coeffs):
+    """Reference implementation: one subtraction per (victim, source) pair of amps"""
+    dataList = [ampExposure.getMaskedImage().getImage().Factory(
+                ampExposure.getMaskedImage().getImage(), amp.getRawDataBBox()).getArray()
+                for ampExposure, amp in ampList]
+    sources = [data.copy() for data in dataList]
+    for i, victim in enumerate(dataList):
+        for j, source in enumerate(sources):
+            if i != j:
+                victim -= coeffs[i][j]*source
+
+
+class AssemblyReached(Exception):
+    """Raised by FakeAssembler to stop runDataRef once the amps have been processed"""
+    pass
+
+
+class FakeAssembler(object):
+    """Stand-in for the assembleCcd subtask that records the amps it is given"""
+
+    def assembleCcd(self, ampDict):
+        self.ampDict = ampDict
+        raise AssemblyReached()
+
+
+class FakeSensorRef(object):
+    """Just enough of a ButlerDataRef to get runDataRef as far as assembly"""
+
+    def __init__(self, ampExposures, crosstalk=None):
+        self.dataId = dict(visit=1)
+        self.ampExposures = ampExposures
+        self.crosstalk = crosstalk
+
+    def datasetExists(self, datasetType):
+        return datasetType == "crosstalk" and self.crosstalk is not None
+
+    def get(self, datasetType, immediate=False):
+        if datasetType == "crosstalk":
+            return self.crosstalk
+        if datasetType == "raw_amp":
+            return self.ampExposures[self.dataId["channel"] - 1]
+        raise KeyError(datasetType)
+
+
+class AmpPassThroughIsrTask(Ts3IsrTask):
+    """Ts3IsrTask without the per-amp processing that precedes crosstalk correction"""
+
+    def convertIntToFloat(self, exposure):
+        return exposure
+
+    def saturationDetection(self, exposure, amp):
+        pass
+
+    def overscanCorrection(self, exposure, amp):
+        pass
+
+
+class CrosstalkTestCase(lsst.utils.tests.TestCase):
+    """Test the batched crosstalk correction against the per-pair reference"""
+
+    def setUp(self):
+        rng = numpy.random.RandomState(12345)
+        # Asymmetric, with every element distinct, so that a transposition would be detected
+        self.coeffs = rng.uniform(-1.0e-3, 1.0e-3, (16, 16))
+        self.assertFalse(numpy.allclose(self.coeffs, self.coeffs.T))
+        self.detector = Ts3()[0]
+        self.amps = list(self.detector)
+        self.rawImages = []
+        for channel, amp in enumerate(self.amps):
+            # Different level and a gradient per amp, plus a bright spot in a few
+            rawBBox = amp.getRawBBox()
+            image = numpy.zeros((rawBBox.getHeight(), rawBBox.getWidth()), dtype=numpy.float32)
+            image += 100.0*(channel + 1) + rng.normal(0.0, 5.0, image.shape)
+            image += numpy.arange(image.shape[1], dtype=numpy.float32)*0.1*channel
+            if channel % 5 == 0:
+                image[100:120, 200:230] += 50000.0
+            self.rawImages.append(image)
+
+    def makeAmpList(self):
+        ampList = []
+        for amp, array in zip(self.amps, self.rawImages):
+            ampExposure = afwImage.ExposureF(amp.getRawBBox())
+            ampExposure.getMaskedImage().getImage().getArray()[:] = array
+            ampExposure.setDetector(self.detector)
+            ampList.append((ampExposure, amp))
+        return ampList
+
+    def testAgainstNaive(self):
+        batchedList = self.makeAmpList()
+        naiveList = self.makeAmpList()
+        task = Ts3IsrTask()
+
+        start = time.time()
+        task.crosstalkCorrection(batchedList, self.coeffs)
+        batchedTime = time.time() - start
+
+        start = time.time()
+        naiveCrosstalkCorrection(naiveList, self.coeffs)
+        naiveTime = time.time() - start
+        print("Crosstalk correction: batched %.3f sec, naive per-pair %.3f sec" % (batchedTime, naiveTime))
+
+        for (batched, amp), (naive, _) in zip(batchedList, naiveList):
+            numpy.testing.assert_allclose(batched.getMaskedImage().getImage().getArray(),
+                                          naive.getMaskedImage().getImage().getArray(),
+                                          rtol=1.0e-6, atol=1.0e-3, err_msg=amp.getName())
+
+        # Overscan is left alone and the correction is not a no-op
+        for (ampExposure, amp), original in zip(batchedList, self.rawImages):
+            array = ampExposure.getMaskedImage().getImage().getArray()
+            dataBBox = amp.getRawDataBBox()
+            numpy.testing.assert_array_equal(array[:, dataBBox.getMaxX() + 1:],
+                                             original[:, dataBBox.getMaxX() + 1:])
+            self.assertFalse(numpy.allclose(array, original))
+
+    def testDiagonalIgnored(self):
+        coeffs = numpy.identity(16)
+        ampList = self.makeAmpList()
+        Ts3IsrTask().crosstalkCorrection(ampList, coeffs)
+        for (ampExposure, amp), original in zip(ampList, self.rawImages):
+            numpy.testing.assert_array_equal(ampExposure.getMaskedImage().getImage().getArray(), original)
+
+    def testBadShape(self):
+        with self.assertRaises(RuntimeError):
+            Ts3IsrTask().crosstalkCorrection(self.makeAmpList(), numpy.zeros((15, 15)))
+
+
+    def makeRunDataRefTask(self):
+        config = Ts3IsrConfig()
+        config.doCrosstalk = True
+        config.doWrite = False
+        task = AmpPassThroughIsrTask(config=config)
+        task.assembleCcd = FakeAssembler()
+        return task
+
+    def testRunDataRef(self):
+        task = self.makeRunDataRefTask()
+        with self.assertRaises(AssemblyReached):
+            task.runDataRef(FakeSensorRef([ampExposure for ampExposure, amp in self.makeAmpList()],
+                                          self.coeffs))
+
+        naiveList = self.makeAmpList()
+        naiveCrosstalkCorrection(naiveList, self.coeffs)
+        self.assertEqual(len(task.assembleCcd.ampDict), 16)
+        for naive, amp in naiveList:
+            numpy.testing.assert_allclose(
+                task.assembleCcd.ampDict[amp.getName()].getMaskedImage().getImage().getArray(),
+                naive.getMaskedImage().getImage().getArray(),
+                rtol=1.0e-6, atol=1.0e-3, err_msg=amp.getName())
+
+    def testRunDataRefMissingCalib(self):
+        task = self.makeRunDataRefTask()
+        with self.assertRaises(RuntimeError):
+            task.runDataRef(FakeSensorRef([ampExposure for ampExposure, amp in self.makeAmpList()]))
+
+
+class CrosstalkCalibTestCase(lsst.utils.tests.TestCase):
+    """Test reading and writing the crosstalk calibration"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.coeffs = numpy.random.RandomState(12345).uniform(-1.0e-3, 1.0e-3, (16, 16))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def testStdCrosstalk(self):
+        image = afwImage.DecoratedImageF(afwGeom.Extent2I(16, 16))
+        image.getImage().set(0.0)
+        image.getImage().set(3, 5, 0.25)  # x=3 (source channel 4), y=5 (victim channel 6)
+        # std_crosstalk does not use any mapper state, so avoid needing a repository
+        mapper = Ts3Mapper.__new__(Ts3Mapper)
+        coeffs = mapper.std_crosstalk(image, dict(visit=1))
+        self.assertEqual(coeffs.shape, (16, 16))
+        self.assertEqual(coeffs[5, 3], 0.25)
+        self.assertEqual(coeffs[3, 5], 0.0)
+        self.assertEqual(numpy.count_nonzero(coeffs), 1)
+
+        with self.assertRaises(RuntimeError):
+            mapper.std_crosstalk(afwImage.DecoratedImageF(afwGeom.Extent2I(15, 16)), dict(visit=1))
+
+    def testWriteCrosstalk(self):
+        filename = os.path.join(self.dir, "crosstalk.fits")
+        writeCrosstalk(self.coeffs, filename, "2016-05-01")
+        image = afwImage.DecoratedImageF(filename)
+        metadata = image.getMetadata()
+        self.assertEqual(metadata.get("OBSTYPE").strip(), "crosstalk")
+        self.assertEqual(metadata.get("CALIB_ID").strip(), "ccd=0 filter=NONE calibDate=2016-05-01")
+        numpy.testing.assert_allclose(crosstalkFromImage(image), self.coeffs, rtol=1.0e-6)
+
+        with self.assertRaises(RuntimeError):
+            writeCrosstalk(numpy.zeros((16, 15)), filename, "2016-05-01")
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
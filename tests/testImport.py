@@ -0,0 +1,78 @@
+#
+# LSST Data Management System
+# Copyright 2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import print_function
+import subprocess
+import sys
+import unittest
+
+import lsst.utils.tests
+
+HEAVY_MODULES = ("lsst.ip.isr", "lsst.obs.ts3.ts3Mapper", "lsst.obs.ts3.ts3IsrTask")
+
+
+def runPython(code):
+    """Run code in a fresh interpreter and return what it prints"""
+    return subprocess.check_output([sys.executable, "-c", code]).decode().strip()
+
+
+def timeImport(moduleName, repeats=5):
+    """Return the best wall-clock time, in seconds, to import a module in a fresh interpreter"""
+    code = "import time; start = time.time(); import %s; print(time.time() - start)" % (moduleName,)
+    return min(float(runPython(code)) for _ in range(repeats))
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "lazy imports need python 3.7")
+class LazyImportTestCase(lsst.utils.tests.TestCase):
+    """Test that ingest-only processes do not import the mapper and ISR machinery"""
+
+    def testIngestDoesNotImportHeavyModules(self):
+        loaded = runPython("import sys; import lsst.obs.ts3.ingest; "
+                           "print(' '.join(name for name in %r if name in sys.modules))" % (HEAVY_MODULES,))
+        self.assertEqual(loaded, "")
+
+    def testPublicNames(self):
+        loaded = runPython("import sys; import lsst.obs.ts3 as ts3; "
+                           "print('lsst.obs.ts3.ts3IsrTask' in sys.modules); "
+                           "print(ts3.Ts3IsrTask.__name__, ts3.Ts3IsrConfig.__name__, "
+                           "      ts3.Ts3Mapper.__name__); "
+                           "print('lsst.obs.ts3.ts3IsrTask' in sys.modules)")
+        self.assertEqual(loaded.split("\n"), ["False", "Ts3IsrTask Ts3IsrConfig Ts3Mapper", "True"])
+
+    def testImportTime(self):
+        """Report import times; the sys.modules check above is what guards against regressions"""
+        ingestTime = timeImport("lsst.obs.ts3.ingest")
+        isrTime = timeImport("lsst.obs.ts3.ts3IsrTask")
+        print("Import time: lsst.obs.ts3.ingest %.3f sec, lsst.obs.ts3.ts3IsrTask %.3f sec" %
+              (ingestTime, isrTime))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
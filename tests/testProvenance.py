@@ -0,0 +1,230 @@
+#
+# LSST Data Management System
+# Copyright 2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.utils.tests
+from lsst.obs.ts3 import Ts3IsrConfig, Ts3IsrTask
+
+
+class IsrStarted(Exception):
+    """Raised by FakeSensorRef when runDataRef goes on to read the raw amps"""
+    pass
+
+
+class FakeSensorRef(object):
+    """Just enough of a ButlerDataRef to compute provenance and decide whether to skip ISR"""
+
+    def __init__(self, files, defects, postIsrMetadata=None):
+        self.dataId = dict(visit=1)
+        self.files = files
+        self.defects = defects
+        self.postIsrMetadata = postIsrMetadata
+        self.postIsrExposure = afwImage.ExposureF(1, 1)
+
+    def datasetExists(self, datasetType):
+        if datasetType == "postISRCCD":
+            return self.postIsrMetadata is not None
+        return datasetType in self.files
+
+    def get(self, datasetType, immediate=False):
+        if datasetType.endswith("_filename"):
+            return [self.files[datasetType[:-len("_filename")]]]
+        if datasetType == "defects":
+            return self.defects
+        if datasetType == "postISRCCD_md":
+            return self.postIsrMetadata
+        if datasetType == "postISRCCD":
+            return self.postIsrExposure
+        if datasetType == "raw_amp":
+            raise IsrStarted()
+        raise KeyError(datasetType)
+
+
+class ProvenanceTestCase(lsst.utils.tests.TestCase):
+    """Test the provenance digest and the skipping of unchanged ISR"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = {}
+        for datasetType in ("raw", "bias", "flat", "bfKernel"):
+            self.files[datasetType] = os.path.join(self.dir, datasetType + ".fits")
+            self.writeFile(datasetType, datasetType + " contents")
+        self.defects = [afwImage.DefectBase(afwGeom.Box2I(afwGeom.Point2I(3801, 666),
+                                                          afwGeom.Point2I(3805, 669)))]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def writeFile(self, datasetType, contents):
+        with open(self.files[datasetType], "w") as fd:
+            fd.write(contents)
+
+    def makeTask(self, **kwargs):
+        config = Ts3IsrConfig()
+        config.doBias = True
+        config.doLinearize = False
+        config.doDark = False
+        config.doFlat = True
+        config.doBrighterFatter = False
+        config.doFringe = False
+        config.doCrosstalk = False
+        config.doWrite = True
+        config.doSkipUnchanged = False
+        for name, value in kwargs.items():
+            setattr(config, name, value)
+        return Ts3IsrTask(config=config)
+
+    def makeSensorRef(self, digest=None):
+        metadata = None
+        if digest is not None:
+            metadata = dafBase.PropertyList()
+            metadata.set("ISR_PROVENANCE", digest)
+        return FakeSensorRef(self.files, self.defects, metadata)
+
+    def digest(self, **kwargs):
+        return self.makeTask(**kwargs).computeProvenanceDigest(self.makeSensorRef())
+
+    def testStable(self):
+        digest = self.digest()
+        self.assertEqual(self.digest(), digest)
+        self.assertEqual(self.makeTask().computeProvenanceDigest(self.makeSensorRef()), digest)
+
+    def testIgnoredFields(self):
+        digest = self.digest()
+        self.assertEqual(self.digest(doSkipUnchanged=True), digest)
+        self.assertEqual(self.digest(doWrite=False), digest)
+
+    def testDatasetTypes(self):
+        self.assertEqual(self.makeTask().getProvenanceDatasetTypes(), ["raw", "bias", "flat"])
+        self.assertIn("bfKernel", self.makeTask(doBrighterFatter=True).getProvenanceDatasetTypes())
+        self.assertIn("crosstalk", self.makeTask(doCrosstalk=True).getProvenanceDatasetTypes())
+
+    def testInputs(self):
+        digest = self.digest()
+        for datasetType in ("raw", "bias", "flat"):
+            self.writeFile(datasetType, "changed")
+            self.assertNotEqual(self.digest(), digest, datasetType)
+            self.writeFile(datasetType, datasetType + " contents")
+            self.assertEqual(self.digest(), digest, datasetType)
+
+        self.defects.append(afwImage.DefectBase(afwGeom.Box2I(afwGeom.Point2I(1, 2), afwGeom.Point2I(3, 4))))
+        self.assertNotEqual(self.digest(), digest)
+        del self.defects[-1]
+        self.assertEqual(self.digest(), digest)
+
+        self.assertNotEqual(self.digest(fwhm=2.5), digest)
+        self.assertNotEqual(self.digest(doFlat=False), digest)
+
+    def testBrighterFatterKernel(self):
+        # The kernel only counts when it is used
+        digest = self.digest()
+        self.writeFile("bfKernel", "changed")
+        self.assertEqual(self.digest(), digest)
+
+        bfDigest = self.digest(doBrighterFatter=True)
+        self.assertNotEqual(bfDigest, digest)
+        self.writeFile("bfKernel", "changed again")
+        self.assertNotEqual(self.digest(doBrighterFatter=True), bfDigest)
+
+    def testMissingDataset(self):
+        digest = self.digest(doCrosstalk=True)
+        self.assertNotEqual(digest, self.digest())
+        self.assertEqual(self.digest(doCrosstalk=True), digest)
+
+    def testPackageVersions(self):
+        versions = self.makeTask().getProvenanceVersions()
+        for moduleName in ("lsst.obs.ts3", "lsst.afw", "lsst.ip.isr", "lsst.meas.algorithms"):
+            self.assertIn(moduleName, versions)
+
+        digest = self.digest()
+        task = self.makeTask()
+        upgraded = dict(versions)
+        upgraded["lsst.ip.isr"] = "upgraded"
+        task.getProvenanceVersions = lambda: upgraded
+        self.assertNotEqual(task.computeProvenanceDigest(self.makeSensorRef()), digest)
+        task.getProvenanceVersions = lambda: dict(versions)
+        self.assertEqual(task.computeProvenanceDigest(self.makeSensorRef()), digest)
+
+    def testSkipRequiresWrite(self):
+        config = Ts3IsrConfig()
+        config.doSkipUnchanged = True
+        config.doWrite = True
+        config.validate()
+        config.doWrite = False
+        with self.assertRaises(ValueError):
+            config.validate()
+
+    def testSkipAfterRunWithoutFlag(self):
+        digest = self.digest()  # as written by a run without doSkipUnchanged
+        sensorRef = self.makeSensorRef(digest)
+        task = self.makeTask(doSkipUnchanged=True)
+        result = task.runDataRef(sensorRef)
+        self.assertIs(result.exposure, sensorRef.postIsrExposure)
+        self.assertTrue(task.metadata.get("ISR_SKIPPED"))
+
+    def testRedoIfChanged(self):
+        sensorRef = self.makeSensorRef(self.digest(fwhm=2.5))
+        task = self.makeTask(doSkipUnchanged=True)
+        self.assertFalse(task.isProvenanceCurrent(sensorRef, task.computeProvenanceDigest(sensorRef)).current)
+        with self.assertRaises(IsrStarted):
+            task.runDataRef(sensorRef)
+        self.assertFalse(task.metadata.get("ISR_SKIPPED"))
+
+    def testRedoWithoutProvenance(self):
+        sensorRef = self.makeSensorRef()
+        sensorRef.postIsrMetadata = dafBase.PropertyList()
+        task = self.makeTask(doSkipUnchanged=True)
+        with self.assertRaises(IsrStarted):
+            task.runDataRef(sensorRef)
+        self.assertFalse(task.metadata.get("ISR_SKIPPED"))
+
+    def testRedoWithoutOutput(self):
+        task = self.makeTask(doSkipUnchanged=True)
+        with self.assertRaises(IsrStarted):
+            task.runDataRef(self.makeSensorRef())
+        self.assertFalse(task.metadata.get("ISR_SKIPPED"))
+
+    def testNoSkipByDefault(self):
+        sensorRef = self.makeSensorRef(self.digest())
+        task = self.makeTask()
+        with self.assertRaises(IsrStarted):
+            task.runDataRef(sensorRef)
+        self.assertFalse(task.metadata.exists("ISR_SKIPPED"))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()